@@ -4,17 +4,28 @@ Contains the endpoint methods to access the game and make moves.
 Messaging system allows users to keep track of the tic tac toe
 board. """
 
+import logging
+import time
+_IMPORT_START = time.time()
 
 import endpoints
+from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 from protorpc import remote, messages
 
-from models import User, Game
+from models import User, Game, GameArchive
 from models import UserForms, ShowGamesForm, ShowGamesForms
 from models import GameForm, NewGameForm, MakeMoveForm, StringMessage
-from models import RankingForm, RankingForms
+from models import MoveDeltaForm, GameEventForms
+from models import RankingForm, RankingForms, GameHistoryForms
 
-from utils import get_by_urlsafe
+from events import get_log
+from ratelimit import rate_limited
+from utils import get_by_urlsafe, get_key_by_urlsafe
+
+logging.info('api.py imports took %.1f ms',
+             (time.time() - _IMPORT_START) * 1000)
 
 ALLOWED_CLIENTS = [endpoints.API_EXPLORER_CLIENT_ID]
 
@@ -26,6 +37,9 @@ USER_GAMES_REQUEST = endpoints.ResourceContainer(
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 SHOW_GAME_REQUEST = endpoints.ResourceContainer(
   urlsafe_game_key=messages.StringField(1))
+WATCH_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    offset=messages.IntegerField(2, default=0))
 
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
@@ -41,6 +55,7 @@ class TicTacToeApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @rate_limited
     def create_user(self, request):
         """Create a User. Requires a unique username
 
@@ -80,6 +95,7 @@ class TicTacToeApi(remote.Service):
                       path='newgame',
                       name='create_new_game',
                       http_method='POST')
+    @rate_limited
     def create_new_game(self, request):
         """Create a new tictactoe game between 2 players
 
@@ -130,8 +146,11 @@ class TicTacToeApi(remote.Service):
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
             return game.to_form('Game details')
-        else:
-            endpoints.NotFoundException('Game not found. Enter valid key')
+        archive = self._get_archive(request.urlsafe_game_key)
+        if archive:
+            return archive.to_form(request.urlsafe_game_key,
+                                   'Game details (archived)')
+        raise endpoints.NotFoundException('Game not found. Enter valid key')
 
     @endpoints.method(request_message=SHOW_GAME_REQUEST,
                       response_message=GameHistoryForms,
@@ -154,8 +173,59 @@ class TicTacToeApi(remote.Service):
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
             return game.to_historyform()
-        else:
-            endpoints.NotFoundException('Game not found. Enter valid key')
+        archive = self._get_archive(request.urlsafe_game_key)
+        if archive:
+            return archive.to_historyform()
+        raise endpoints.NotFoundException('Game not found. Enter valid key')
+
+    def _get_archive(self, urlsafe_game_key):
+        """Get the archived form of a game that is no longer stored as a
+        Game
+
+        Args:
+          urlsafe_game_key: urlsafekey of the original game
+
+        Returns:
+          Object of class GameArchive or None if the game was not archived
+
+        """
+        key = get_key_by_urlsafe(urlsafe_game_key, Game)
+        return GameArchive.get_by_id(key.id())
+
+    @endpoints.method(request_message=WATCH_GAME_REQUEST,
+                      response_message=GameEventForms,
+                      path='watchgame/{urlsafe_game_key}',
+                      name='watch_game',
+                      http_method='GET')
+    def watch_game(self, request):
+        """Get the events of a game after an offset, for spectators.
+        Served from a copy of the event log shared by all spectators on
+        the instance, so watching does not read the Game itself
+
+        Args:
+          WATCH_GAME_REQUEST: urlsafekey of a game and the sequence of
+          the last event already seen (0 for all events)
+
+        Returns:
+          New moves and results in GameEventForms format, with the offset
+          to pass on the next call. A game cancelled while being watched
+          ends with a 'cancelled' event
+
+        Raises:
+          NotFoundException: If the game does not exist
+
+        """
+        key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        log = get_log(key)
+        forms = log.events_since(request.offset)
+        if log.closed and not log.forms:
+            raise endpoints.NotFoundException(
+                'Game not found. Enter valid key')
+        result = GameEventForms(items=forms)
+        result.offset = forms[-1].sequence if forms else request.offset
+        result.game_ended = (bool(log.forms) and
+                             log.forms[-1].kind in ('result', 'cancelled'))
+        return result
 
     @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=ShowGamesForms,
@@ -198,9 +268,9 @@ class TicTacToeApi(remote.Service):
         """
 
         if symbol == 'X':
-            opponent = game.userO.get().name
+            opponent = User.get_name(game.userO)
         else:
-            opponent = game.userX.get().name
+            opponent = User.get_name(game.userX)
         f = ShowGamesForm()
         f.symbol = symbol
         f.opponent = opponent
@@ -212,6 +282,7 @@ class TicTacToeApi(remote.Service):
                       path='cancelgame/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='POST')
+    @rate_limited
     def cancel_game(self, request):
         """Cancel a game and remove from database
 
@@ -229,7 +300,8 @@ class TicTacToeApi(remote.Service):
         """
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
-            endpoints.NotFoundException('Game not found. Enter valid key')
+            raise endpoints.NotFoundException(
+                'Game not found. Enter valid key')
         if game.game_ended:
             raise endpoints.ForbiddenException('Game has already ended')
         game.delete_game()
@@ -252,7 +324,7 @@ class TicTacToeApi(remote.Service):
         """
         users = User.query().fetch()
         if not users:
-            raise NotFoundException('No users not found')
+            raise endpoints.NotFoundException('No users not found')
 
         ranked_users = []
         for user in users:
@@ -283,6 +355,7 @@ class TicTacToeApi(remote.Service):
                       path='makemove/{urlsafe_game_key}',
                       name='make_move',
                       http_method='POST')
+    @rate_limited
     def make_move(self, request):
         """Validates a move, records it and moves the game forward. Also
         adds email alerts to taskqueue to inform next user of pending moves
@@ -305,15 +378,78 @@ class TicTacToeApi(remote.Service):
           UnauthorizedException:
             Wrong player is trying to make a move
 
+        """
+        game = self._play_move(request)
+        if game.winner:
+            message = 'Game over, {} wins !'.format(
+                                        User.get_name(game.winner))
+        elif game.draw:
+            message = 'It is a Draw ! Well Played both'
+        else:
+            message = 'Nice move ! {} to play next'.format(
+                                    User.get_name(game.next_turn))
+        return game.to_form(message)
+
+    @endpoints.method(request_message=MAKE_MOVE_REQUEST,
+                      response_message=MoveDeltaForm,
+                      path='makemovecompact/{urlsafe_game_key}',
+                      name='make_move_compact',
+                      http_method='POST')
+    @rate_limited
+    def make_move_compact(self, request):
+        """Same as make_move but returns only what changed. Intended for
+        clients making many moves, as it skips building the full GameForm
+
+        Args:
+          urlsafekey, row, col and player name making the move in the game
+
+        Returns:
+          The move, new turn count, game status and packed board in
+          MoveDeltaForm format
+
+        Raises:
+          Same as make_move
+
+        """
+        game = self._play_move(request)
+        return game.to_deltaform(request.row, request.col)
+
+    def _play_move(self, request):
+        """Validate and record a move and queue the email notification
+
+        Args:
+          MAKE_MOVE_REQUEST: urlsafekey, row, col and player name
+
+        Returns:
+          The updated game
+
+        Raises:
+          ConflictException: If other moves kept being saved to the game
+          while this one was being made
+
+        """
+        try:
+            return self._play_move_transaction(request)
+        except datastore_errors.TransactionFailedError:
+            raise endpoints.ConflictException(
+                'Another move was made at the same time, reload the game')
+
+    @ndb.transactional(xg=True)
+    def _play_move_transaction(self, request):
+        """Same as _play_move, in a transaction covering the game and its
+        players. A move saved concurrently makes the transaction retry, so
+        the move is validated again against the game it is saved over
+
         """
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
-            endpoints.NotFoundException('Game not found. Enter valid key')
+            raise endpoints.NotFoundException(
+                'Game not found. Enter valid key')
         if game.game_ended:
             raise endpoints.ForbiddenException('Game has already ended')
-        if game.next_turn.get().name != request.user:
+        if User.get_name(game.next_turn) != request.user:
             raise endpoints.UnauthorizedException("It is {}'s turn".format(
-                            game.next_turn.get().name))
+                            User.get_name(game.next_turn)))
         if request.row not in range(3):
             raise endpoints.ForbiddenException('Row must be between 0 and 2')
         if request.col not in range(3):
@@ -326,27 +462,20 @@ class TicTacToeApi(remote.Service):
             symbol = "O"
 
         game = game.record_move(request.row, request.col, symbol)
-        game.put()
-
-        # Set up taskqueues to send notifications
-        email_to = game.next_turn.get().email
+        # Set up taskqueues to send notifications. The task looks up the
+        # email address, so the move itself does not read the user
+        params = {'to_user': game.next_turn.urlsafe()}
         if game.check_winner():
-            taskqueue.add(url='/SendMoveNotification',
-                          params={'to': email_to, 'state': 'win',
-                                  'opponent': game.winner.get().name})
-            return game.to_form('Game over, {} wins !'.format(
-                                        game.winner.get().name))
-
+            params['state'] = 'win'
+            params['winner'] = game.winner.urlsafe()
         elif game.check_draw():
-            taskqueue.add(url='/SendMoveNotification',
-                          params={'to': email_to, 'state': 'draw'})
-            return game.to_form('It is a Draw ! Well Played both')
-
+            params['state'] = 'draw'
         else:
-            taskqueue.add(url='/SendMoveNotification',
-                          params={'to': email_to, 'state': ''})
-            return game.to_form('Nice move ! {} to play next'.format(
-                                    game.next_turn.get().name))
+            params['state'] = ''
+        game.save()
+        taskqueue.add(url='/SendMoveNotification', params=params,
+                      transactional=True)
+        return game
 
 
 app = endpoints.api_server([TicTacToeApi])
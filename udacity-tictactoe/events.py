@@ -0,0 +1,117 @@
+"""events.py - Per-instance fan-out of game event logs to spectators.
+
+Each watched game has one in-memory copy of its GameEvent log per instance.
+All spectators on the instance read from that copy, and only one of them
+reads new events from the datastore, when the event count published in
+memcache by Game.save shows the copy is behind. If memcache has no
+count, the copy is refreshed at most once every POLL_INTERVAL seconds.
+
+Every refresh also reads the Game itself, in the same batch get when the
+event count is known. A game that no longer exists closes the log: if it
+had not ended, spectators get a final 'cancelled' event, and if it never
+existed the log stays empty so watch_game can report it as not found."""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import GameEvent, GameEventForm
+
+# Seconds between datastore reads for a game when memcache has no count
+POLL_INTERVAL = 1.0
+# Seconds after which a copy is refreshed even if memcache says it is current
+MAX_STALENESS = 30.0
+# Games kept in memory, least recently watched are dropped first
+MAX_GAMES = 1000
+
+
+class EventLog(object):
+    """In-memory copy of the events of one game, as GameEventForms"""
+    def __init__(self, game_key):
+        self.game_key = game_key
+        self.forms = []
+        self.checked = 0
+        self.closed = False
+        # Whether the game existed at an earlier refresh
+        self.seen = False
+        self.lock = threading.Lock()
+
+    def is_current(self, head, now):
+        """Check if the copy needs no refresh
+        Args:
+            head: event count from memcache, or None if unknown
+            now: current time in seconds"""
+        if now - self.checked > MAX_STALENESS:
+            return False
+        if head is None:
+            return now - self.checked < POLL_INTERVAL
+        return head <= len(self.forms)
+
+    def refresh(self):
+        """Read any events missing from the copy. Concurrent callers wait
+        for a single datastore read instead of making their own"""
+        if self.closed:
+            return
+        head = memcache.get(GameEvent.HEAD_KEY % self.game_key.urlsafe())
+        if self.is_current(head, time.time()):
+            return
+        with self.lock:
+            if self.closed or self.is_current(head, time.time()):
+                return
+            if head is not None and head > len(self.forms):
+                # Event ids are their sequence numbers, so the game and
+                # the new events come back from a single batch get
+                keys = [self.game_key] + [
+                    ndb.Key(GameEvent, sequence, parent=self.game_key)
+                    for sequence in range(len(self.forms) + 1, head + 1)]
+                entities = ndb.get_multi(keys)
+                game = entities[0]
+                events = [event for event in entities[1:] if event]
+            else:
+                game_future = self.game_key.get_async()
+                query = GameEvent.query(ancestor=self.game_key)
+                if self.forms:
+                    last = ndb.Key(GameEvent, len(self.forms),
+                                   parent=self.game_key)
+                    query = query.filter(GameEvent.key > last)
+                events = query.fetch()
+                game = game_future.get_result()
+            self.forms.extend(event.to_form() for event in events)
+            if game is None:
+                self.close()
+            else:
+                self.seen = True
+            self.checked = time.time()
+
+    def close(self):
+        """Stop refreshing the log of a game that no longer exists"""
+        self.closed = True
+        ended = self.forms and self.forms[-1].kind == 'result'
+        if self.seen and not ended:
+            self.forms.append(GameEventForm(sequence=len(self.forms) + 1,
+                                            kind='cancelled'))
+
+    def events_since(self, offset):
+        """Returns the GameEventForms with a sequence greater than offset"""
+        self.refresh()
+        # Sequences are 1, 2, 3... so the form at index offset comes next
+        return self.forms[max(offset, 0):]
+
+
+_logs = collections.OrderedDict()
+_logs_lock = threading.Lock()
+
+
+def get_log(game_key):
+    """Returns the shared EventLog of a game, creating it if needed"""
+    with _logs_lock:
+        log = _logs.pop(game_key, None)
+        if log is None:
+            log = EventLog(game_key)
+        _logs[game_key] = log
+        while len(_logs) > MAX_GAMES:
+            _logs.popitem(last=False)
+        return log
@@ -14,10 +14,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
+import logging
+import os
+import time
+_IMPORT_START = time.time()
+from datetime import datetime, timedelta
+
 import webapp2
-from google.appengine.api import mail
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Game, GameArchive, User
+from models import StatsReconciliation, StatsShard
+from stats import tally_games, merge_counts, count_drift, correct_user
+
+# mail, taskqueue and the endpoints API (api.py, ratelimit.py) are only
+# imported by the handlers that use them, so a cold start for a task only
+# loads webapp2, ndb and the models (which need protorpc for their forms)
+logging.info('main.py imports took %.1f ms',
+             (time.time() - _IMPORT_START) * 1000)
 SENDER = 'TicTacToe admin <possible-arbor-125505@appspot.gserviceaccount.com>'
 
+# Games processed per cleanup task before checkpointing the cursor
+CLEANUP_BATCH_SIZE = int(os.environ.get('CLEANUP_BATCH_SIZE', 100))
+# In-progress games untouched for this long are cancelled
+GAME_IDLE_TIMEOUT_HOURS = int(os.environ.get('GAME_IDLE_TIMEOUT_HOURS', 72))
+# Ended games stay readable as Game entities for this long before archiving
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 30))
+# Games scanned by each stats reconciliation shard
+RECONCILE_SHARD_SIZE = int(os.environ.get('RECONCILE_SHARD_SIZE', 500))
+# Shards planned by each reconciliation planning task
+RECONCILE_PLAN_SHARDS = int(os.environ.get('RECONCILE_PLAN_SHARDS', 20))
+RECONCILE_KINDS = {'Game': Game, 'GameArchive': GameArchive}
+RECONCILE_ORDER = ['Game', 'GameArchive']
+CLEANUP_PHASES = ('backfill', 'archive', 'expire')
+
 
 class MainHandler(webapp2.RequestHandler):
     """Default class that prints a simple hello world message"""
@@ -25,27 +57,365 @@ class MainHandler(webapp2.RequestHandler):
         self.response.write('Hello world!')
 
 
+class WarmupHandler(webapp2.RequestHandler):
+    """Prepare a new instance before it receives user traffic"""
+    def get(self):
+        """Build the endpoints service and prime the user name cache so
+        the first user request does not pay for them
+        """
+        start = time.time()
+        import api  # importing builds the endpoints service
+        User.prime_name_cache()
+        logging.info('Warmup took %.1f ms, %d user names cached',
+                     (time.time() - start) * 1000, len(User._names))
+        self.response.write('Warmed up')
+
+
 class Mailer(webapp2.RequestHandler):
     """Send emails to players informing them about their move
 
     """
     def post(self):
-    """Method to send email to player after a move from opponent has been 
-    successfully recorded
-    """
+        """Method to send email to player after a move from opponent has been
+        successfully recorded
+        """
+        from google.appengine.api import mail
+        params = self.request.POST
+        if 'to_user' in params:
+            user = ndb.Key(urlsafe=params['to_user']).get()
+            email = user and user.email
+        else:
+            # Tasks queued by the previous release carry the email address
+            # and winner name instead of user keys. Remove after one release
+            email = params.get('to')
+        if not email:
+            return
         message = mail.EmailMessage()
-        message.to = self.request.POST['to']
+        message.to = email
         message.sender = SENDER
         message.subject = 'Your move pending in tictactoe !'
         message.body = "Your opponent just made their move. Your turn ! "
-        if self.request.POST['state'] == "win":
-            message.body += "Result: Game over ! %s wins" % self.request.POST['opponent']
-        elif self.request.POST['state'] == "draw":
+        if params['state'] == "win":
+            if 'winner' in params:
+                winner = User.get_name(ndb.Key(urlsafe=params['winner']))
+            else:
+                winner = params.get('opponent')
+            message.body += "Result: Game over ! %s wins" % winner
+        elif params['state'] == "draw":
             message.body += "Result: Game drawn"
         else:
             message.body += "It is now your turn !"
         message.send()
 
+class CleanupGames(webapp2.RequestHandler):
+    """Archive ended games and cancel abandoned ones in bounded batches
+
+    Runs in two phases: 'archive' moves games that ended more than
+    ARCHIVE_AFTER_DAYS ago into GameArchive, 'expire' cancels in-progress
+    games idle past GAME_IDLE_TIMEOUT_HOURS. Each request handles one batch
+    and checkpoints its cursor by queueing the next batch as a new task.
+
+    Games stored before Game.updated existed are not found by either
+    phase. The one-off 'backfill' phase (GET ?phase=backfill) re-puts them
+    so they get an updated time and are cleaned up one window later.
+    """
+    def get(self):
+        """Entry point for the cron job, starts from the first phase"""
+        self.run_batch(self.request.get('phase', 'archive'), None)
+
+    def post(self):
+        """Continuation of a previous batch"""
+        cursor = self.request.POST.get('cursor')
+        self.run_batch(self.request.POST.get('phase', 'archive'),
+                       Cursor(urlsafe=cursor) if cursor else None)
+
+    def run_batch(self, phase, cursor):
+        """Process a single batch and queue the next one, if any
+
+        Args:
+            phase: 'backfill', 'archive' or 'expire'
+            cursor: query cursor to resume from, or None to start over
+
+        """
+        if phase not in CLEANUP_PHASES:
+            logging.error('Cleanup: unknown phase %r', phase)
+            self.response.set_status(400)
+            self.response.write('Unknown phase')
+            return
+        # auto_now stores UTC times
+        if phase == 'backfill':
+            query = Game.query()
+        elif phase == 'archive':
+            cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+            query = Game.query(Game.game_ended == True, Game.updated < cutoff)
+        elif phase == 'expire':
+            cutoff = (datetime.utcnow() -
+                      timedelta(hours=GAME_IDLE_TIMEOUT_HOURS))
+            query = Game.query(Game.game_ended == False, Game.updated < cutoff)
+        games, next_cursor, more = query.fetch_page(CLEANUP_BATCH_SIZE,
+                                                    start_cursor=cursor)
+        if phase == 'backfill':
+            for game in games:
+                if game.updated is None:
+                    backfill_game(game.key)
+        elif phase == 'archive':
+            # Archive ids match game ids, so a rerun after a failure
+            # overwrites rather than duplicates
+            ndb.put_multi([game.archive() for game in games])
+            ndb.delete_multi([key for game in games
+                              for key in game.event_keys() + [game.key]])
+        elif phase == 'expire':
+            for game in games:
+                try:
+                    game.delete_game()
+                except Exception:
+                    logging.exception('Could not cancel idle game %s',
+                                      game.key.urlsafe())
+        logging.info('Cleanup %s: processed %d games', phase, len(games))
+
+        from google.appengine.api import taskqueue
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/cleanup_games',
+                          params={'phase': phase,
+                                  'cursor': next_cursor.urlsafe()})
+        elif phase == 'archive':
+            taskqueue.add(url='/tasks/cleanup_games',
+                          params={'phase': 'expire'})
+
+
+@ndb.transactional
+def backfill_game(game_key):
+    """Give a game stored before Game.updated existed an updated time.
+    The game is re-read in the transaction, so a move saved since the
+    batch was fetched is not overwritten"""
+    game = game_key.get()
+    if game and game.updated is None:
+        # auto_now sets updated on put
+        game.put()
+
+
+class ReconcileStats(webapp2.RequestHandler):
+    """Start a run that rebuilds User statistics from Game and GameArchive
+    entities. ReconcileStatsPlan splits the games into cursor ranges of
+    RECONCILE_SHARD_SIZE, a few at a time in chained tasks, and queues a
+    ReconcileStatsMap task to count each range as soon as it is found.
+    Once planning is done and every shard is counted, ReconcileStatsReduce
+    sums the shards and corrects the users.
+    """
+    def get(self):
+        """Entry point for the cron job"""
+        from google.appengine.api import taskqueue
+        run = StatsReconciliation()
+        run.put()
+        taskqueue.add(url='/tasks/reconcile_stats/plan',
+                      params={'run': run.key.urlsafe(), 'kind': 0,
+                              'shard': 0})
+        logging.info('Stats reconciliation %s started', run.key.id())
+
+
+class ReconcileStatsPlan(webapp2.RequestHandler):
+    """Find the start and end cursors of up to RECONCILE_PLAN_SHARDS shards
+    and queue their map tasks, then queue the next planning task"""
+    def post(self):
+        from google.appengine.api import taskqueue
+        run_key = ndb.Key(urlsafe=self.request.POST['run'])
+        kind = int(self.request.POST['kind'])
+        shard = int(self.request.POST['shard'])
+        cursor = self.request.POST.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+
+        model = RECONCILE_KINDS[RECONCILE_ORDER[kind]]
+        more = True
+        for _ in range(RECONCILE_PLAN_SHARDS):
+            keys, next_cursor, more = model.query().fetch_page(
+                RECONCILE_SHARD_SIZE, start_cursor=cursor, keys_only=True)
+            if not keys:
+                more = False
+                break
+            params = {'run': run_key.urlsafe(), 'shard': shard,
+                      'kind': RECONCILE_ORDER[kind]}
+            if cursor:
+                params['cursor'] = cursor.urlsafe()
+            # Shards end where the next one starts, so games created or
+            # deleted before the map runs cannot move a game between them
+            if more and next_cursor:
+                params['end_cursor'] = next_cursor.urlsafe()
+            taskqueue.add(url='/tasks/reconcile_stats/map', params=params)
+            shard += 1
+            cursor = next_cursor
+            if not more:
+                break
+
+        if more:
+            params = {'run': run_key.urlsafe(), 'kind': kind, 'shard': shard,
+                      'cursor': cursor.urlsafe()}
+        elif kind + 1 < len(RECONCILE_ORDER):
+            params = {'run': run_key.urlsafe(), 'kind': kind + 1,
+                      'shard': shard}
+        else:
+            finish_planning(run_key, shard)
+            return
+        taskqueue.add(url='/tasks/reconcile_stats/plan', params=params)
+
+
+@ndb.transactional
+def finish_planning(run_key, shards):
+    """Record the final number of shards of a run, and start the reduce
+    step if all of them have already been counted"""
+    run = run_key.get()
+    if run.planned:
+        return
+    run.planned = True
+    run.shards = shards
+    run.put()
+    queue_reduce_if_done(run)
+    logging.info('Stats reconciliation %s planned %d shards',
+                 run_key.id(), shards)
+
+
+def queue_reduce_if_done(run):
+    """Queue the reduce step of a run once it is planned and every shard
+    is counted. Must be called in the transaction that last updated run"""
+    from google.appengine.api import taskqueue
+    if run.planned and run.shards_done == run.shards:
+        taskqueue.add(url='/tasks/reconcile_stats/reduce',
+                      params={'run': run.key.urlsafe()}, transactional=True)
+
+
+class ReconcileStatsMap(webapp2.RequestHandler):
+    """Count the games of a single shard, between its start and end cursors.
+    The last shard of a kind has no end cursor"""
+    def post(self):
+        run_key = ndb.Key(urlsafe=self.request.POST['run'])
+        shard = int(self.request.POST['shard'])
+        model = RECONCILE_KINDS[self.request.POST['kind']]
+        cursor = self.request.POST.get('cursor')
+        end_cursor = self.request.POST.get('end_cursor')
+        games = model.query().iter(
+            batch_size=RECONCILE_SHARD_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None,
+            end_cursor=Cursor(urlsafe=end_cursor) if end_cursor else None)
+        counts = tally_games(games)
+
+        @ndb.transactional
+        def record_shard():
+            # The shard id makes a retried task a no-op
+            if StatsShard.get_by_id(shard + 1, parent=run_key):
+                return
+            StatsShard(id=shard + 1, parent=run_key, counts=counts).put()
+            run = run_key.get()
+            run.shards_done += 1
+            run.put()
+            queue_reduce_if_done(run)
+        record_shard()
+
+
+class ReconcileStatsReduce(webapp2.RequestHandler):
+    """Sum the shard counts and correct users whose counters drifted.
+
+    The shards are snapshots taken at different times, so a user is left
+    alone if any of their games was created, changed or archived after the
+    run started, or if their counters were written since then. Corrections
+    are applied in a transaction per user that re-checks the latter.
+
+    The task may be delivered more than once. A run that is already
+    finished is not reduced again, and the shards are only deleted once
+    the run is stored as finished.
+    """
+    def post(self):
+        run = ndb.Key(urlsafe=self.request.POST['run']).get()
+        if run.finished:
+            logging.info('Stats reconciliation %s already finished',
+                         run.key.id())
+            return
+        shards = StatsShard.query(ancestor=run.key).fetch()
+        if len(shards) != run.shards:
+            logging.error('Stats reconciliation %s has %d of %d shards, '
+                          'not reducing', run.key.id(), len(shards),
+                          run.shards)
+            return
+        counts = merge_counts(shard.counts for shard in shards)
+
+        changed = set()
+        for game in Game.query(Game.updated > run.started):
+            changed.update([game.userX, game.userO])
+        for archive in GameArchive.query(GameArchive.archived > run.started):
+            changed.update([archive.userX, archive.userO])
+
+        run.drift = 0
+        run.users_corrected = 0
+        run.users_skipped = 0
+        users = User.query().fetch()
+        for user in users:
+            if user.key in changed:
+                run.users_skipped += 1
+                continue
+            row = counts.get(user.key.urlsafe())
+            if not count_drift(user, row):
+                continue
+            drift = correct_user_transaction(user.key, row, run.started)
+            if drift is None:
+                run.users_skipped += 1
+            else:
+                run.drift += drift
+                run.users_corrected += 1
+
+        run.users_checked = len(users)
+        run.finished = datetime.utcnow()
+        if not finish_run(run):
+            return
+        ndb.delete_multi([shard.key for shard in shards])
+        logging.info('Stats reconciliation: %d of %d users corrected, '
+                     '%d skipped, total drift %d', run.users_corrected,
+                     run.users_checked, run.users_skipped, run.drift)
+
+
+@ndb.transactional
+def finish_run(run):
+    """Store a reduced run unless a duplicate reduce task finished it first
+
+    Returns:
+        True if the run was stored
+    """
+    if run.key.get().finished:
+        return False
+    run.put()
+    return True
+
+
+@ndb.transactional
+def correct_user_transaction(user_key, row, started):
+    """Correct the counters of one user unless they were written after the
+    run started
+
+    Returns:
+        The drift corrected, or None if the user was skipped
+    """
+    user = user_key.get()
+    if user.updated and user.updated > started:
+        return None
+    drift = correct_user(user, row)
+    if drift:
+        user.put()
+    return drift
+
+
+class RateLimitStats(webapp2.RequestHandler):
+    """Report the rate limiter decisions made by this instance"""
+    def get(self):
+        from ratelimit import limiter
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(limiter.stats()))
+
+
 app = webapp2.WSGIApplication([
-    ('/SendMoveNotification', Mailer), ('/', MainHandler)
+    ('/SendMoveNotification', Mailer),
+    ('/tasks/cleanup_games', CleanupGames),
+    ('/tasks/reconcile_stats', ReconcileStats),
+    ('/tasks/reconcile_stats/plan', ReconcileStatsPlan),
+    ('/tasks/reconcile_stats/map', ReconcileStatsMap),
+    ('/tasks/reconcile_stats/reduce', ReconcileStatsReduce),
+    ('/admin/ratelimit_stats', RateLimitStats),
+    ('/_ah/warmup', WarmupHandler),
+    ('/', MainHandler)
 ], debug=True)
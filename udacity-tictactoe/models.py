@@ -4,8 +4,15 @@ classes they can include methods (such as 'to_form' and 'new_game')."""
 
 from datetime import date
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from symmetry import canonicalize
+
+
+# Base-3 digit of each cell value in Game.board_code
+BOARD_DIGITS = {'_': 0, 'X': 1, 'O': 2}
+
 
 class User(ndb.Model):
     """User profile"""
@@ -15,6 +22,34 @@ class User(ndb.Model):
     games_completed = ndb.IntegerProperty(default=0)
     games_won = ndb.IntegerProperty(default=0)
     games_drawn = ndb.IntegerProperty(default=0)
+    # Last time the counters were written, used by the stats reconciliation
+    # job to leave alone users whose games changed while it ran
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    # Per-instance cache of user key -> user name. Names never change once
+    # a user is created, so entries never need to be invalidated
+    _names = {}
+    # Most names kept in the cache, later lookups go to the datastore
+    NAME_CACHE_SIZE = 10000
+
+    @classmethod
+    def get_name(cls, key):
+        """Returns the name of the user a key points to, reading the
+        datastore only on the first lookup of each key in this instance"""
+        name = cls._names.get(key)
+        if name is None:
+            name = key.get().name
+            if len(cls._names) < cls.NAME_CACHE_SIZE:
+                cls._names[key] = name
+        return name
+
+    @classmethod
+    def prime_name_cache(cls):
+        """Load the names of up to NAME_CACHE_SIZE users into the name
+        cache"""
+        for user in cls.query().fetch(cls.NAME_CACHE_SIZE,
+                                      projection=[cls.name]):
+            cls._names[user.key] = user.name
 
     def to_form(self):
         return UserForm(name=self.name, email=self.email,
@@ -51,6 +86,11 @@ class Game(ndb.Model):
     game_state = ndb.StructuredProperty(TicTacToe)
     debug = ndb.StringProperty()
     history = ndb.StructuredProperty(GameHistory, repeated=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    events_logged = ndb.IntegerProperty(default=0, indexed=False)
+
+    # Per-instance cache of canonical position -> winning symbol
+    _winners = {}
 
     @classmethod
     def new_game(cls, userX, userO):
@@ -86,13 +126,13 @@ class Game(ndb.Model):
 
         """
         form = GameForm()
-        form.userX = self.userX.get().name
-        form.userO = self.userO.get().name
+        form.userX = User.get_name(self.userX)
+        form.userO = User.get_name(self.userO)
         form.row1 = self.game_state.row1
         form.row2 = self.game_state.row2
         form.row3 = self.game_state.row3
         form.turns_played = self.turns_played
-        form.next_turn = self.next_turn.get().name
+        form.next_turn = User.get_name(self.next_turn)
         form.game_ended = self.game_ended
         form.urlsafekey = self.key.urlsafe()
         form.message = message
@@ -100,13 +140,56 @@ class Game(ndb.Model):
         form.draw = self.draw
         return form
 
+    def to_deltaform(self, row, col):
+        """Returns a MoveDeltaForm for the move just made at row, col.
+        Unlike to_form this needs no user lookups
+
+        Args:
+            row, column of the last move
+
+        Returns:
+            Move result in the MoveDeltaForm format
+
+        """
+        form = MoveDeltaForm()
+        form.row = row
+        form.col = col
+        form.symbol = self.symbol_at(row, col)
+        form.turns_played = self.turns_played
+        form.board = self.board_code()
+        form.game_ended = self.game_ended
+        form.draw = self.draw
+        if self.winner:
+            form.winner = 'X' if self.winner == self.userX else 'O'
+        if not self.game_ended:
+            form.next_turn = 'X' if self.next_turn == self.userX else 'O'
+        return form
+
+    def symbol_at(self, row, col):
+        """Returns the symbol ('X', 'O' or '_') in a cell of the board"""
+        return (self.game_state.row1, self.game_state.row2,
+                self.game_state.row3)[row][col]
+
+    def board_code(self):
+        """Pack the board into a single integer. Cell row * 3 + col is the
+        base-3 digit of that weight, with '_' = 0, 'X' = 1 and 'O' = 2
+
+        Returns:
+            Integer between 0 and 3 ** 9 - 1
+
+        """
+        code = 0
+        for cell in reversed(self.board_string()):
+            code = code * 3 + BOARD_DIGITS[cell]
+        return code
+
     def to_historyform(self):
         """Returns a GameHistoryForm representation of the Game history"""
         ret = GameHistoryForms()
         for history in self.history:
             form = GameHistoryForm()
             form.sequence = history.sequence
-            form.user = history.user.get().name
+            form.user = User.get_name(history.user)
             form.move = history.move
             form.result = history.result
             ret.items.append(form)
@@ -114,7 +197,8 @@ class Game(ndb.Model):
 
     def game_over(self, winner, draw):
         """End the game, record the winner or draw for history
-        and update user statistics in User objects
+        and update user statistics in User objects. The users are stored
+        together with the game by save
 
         Args:
             winner: user key for winner of the game
@@ -124,12 +208,11 @@ class Game(ndb.Model):
         if not winner and not draw:
             raise ValueError("No winner specified")
         self.game_ended = True
-        userX = self.userX.get()
-        userO = self.userO.get()
+        userX, userO = ndb.get_multi([self.userX, self.userO])
         if not draw:
             self.winner = winner
-            winner.get().games_won += 1
-            self.history[len(self.history)-1].result = '%s won !' % winner.get().name
+            (userX if winner == self.userX else userO).games_won += 1
+            self.history[len(self.history)-1].result = '%s won !' % User.get_name(winner)
         else:
             self.draw = True
             userX.games_drawn += 1
@@ -139,9 +222,9 @@ class Game(ndb.Model):
         userO.games_in_progress -= 1
         userX.games_completed += 1
         userO.games_completed += 1
-        userX.put()
-        userO.put()
-        self.put()
+        self._save_with_game(userX, userO)
+        self.log_event('result', winner,
+                       result=self.history[len(self.history)-1].result)
 
     def validate_move(self, row, col):
         """Check if move is on empty space
@@ -161,7 +244,8 @@ class Game(ndb.Model):
         return False
 
     def record_move(self, row, col, symbol):
-        """Record the move in the game state and update next turn
+        """Record the move in the game state and update next turn. Nothing
+        is stored until save is called
 
         Args:
             row, column and symbol of the move
@@ -208,7 +292,7 @@ class Game(ndb.Model):
         history.move = (','.join([str(row), str(col)]))
         self.history.append(history)
 
-        self.put()
+        self.log_event('move', history.user, move=history.move)
         return self
 
     def check_winner(self):
@@ -217,50 +301,77 @@ class Game(ndb.Model):
         Returns:
             Boolean flag if game has ended in a win
 
+        """
+        symbol = self.winning_symbol()
+        if symbol == 'X':
+            self.game_over(self.userX, False)
+        elif symbol == 'O':
+            self.game_over(self.userO, False)
+        return bool(symbol)
+
+    def board_string(self):
+        """Returns the board as a single 9 character string"""
+        return (self.game_state.row1 + self.game_state.row2 +
+                self.game_state.row3)
+
+    def position_key(self):
+        """Returns the canonical form of the board, shared by all boards
+        that are rotations or reflections of each other"""
+        return canonicalize(self.board_string())[0]
+
+    def winning_symbol(self):
+        """Find the symbol that has 3 in a row. Results are cached per
+        canonical position as symmetric boards have the same winner
+
+        Returns:
+            'X', 'O' or '' if no one has won
+
+        """
+        key = self.position_key()
+        symbol = Game._winners.get(key)
+        if symbol is None:
+            symbol = self._find_winning_symbol()
+            Game._winners[key] = symbol
+        return symbol
+
+    def _find_winning_symbol(self):
+        """Check the rows, columns and diagonals of the board
+
+        Returns:
+            'X', 'O' or '' if no one has won
+
         """
         game_arrayX = self.generateArray("X")
         game_arrayO = self.generateArray("O")
-        win = False
         winner = ''
         """Check row totals for userX"""
         for row in range(3):
             if sum(game_arrayX[row][col] for col in range(3)) == 3:
-                win = True
-                winner = self.userX
+                winner = 'X'
         """Check column totals for userX"""
         for col in range(3):
             if sum(game_arrayX[row][col] for row in range(3)) == 3:
-                win = True
-                winner = self.userX
+                winner = 'X'
         """Check diagonal totals for userX"""
         if sum(game_arrayX[row][row] for row in range(3)) == 3:
-            win = True
-            winner = self.userX
+            winner = 'X'
         if sum(game_arrayX[row][2-row] for row in range(3)) == 3:
-            win = True
-            winner = self.userX
+            winner = 'X'
         """Check row totals for userO"""
         for row in range(3):
             if sum(game_arrayO[row][col] for col in range(3)) == 3:
-                win = True
-                winner = self.userO
+                winner = 'O'
         """Check column totals for userO"""
         for col in range(3):
             if sum(game_arrayO[row][col] for row in range(3)) == 3:
-                win = True
-                winner = self.userO
+                winner = 'O'
         """Check diagonal totals for userO"""
         if sum(game_arrayO[row][row] for row in range(3)) == 3:
-            win = True
-            winner = self.userO
+            winner = 'O'
         if sum(game_arrayO[row][2-row] for row in range(3)) == 3:
-            win = True
-            winner = self.userO
-
-        if win:
-            self.game_over(winner, False)
+            winner = 'O'
 
-        return win
+        return winner
 
     def check_draw(self):
         """Check if the game is a draw
@@ -298,10 +409,72 @@ class Game(ndb.Model):
             userO.games_in_progress -= 1
             userX.put()
             userO.put()
-            self.key.delete()
+            ndb.delete_multi(self.event_keys() + [self.key])
+            # Make spectators' event logs refresh and notice the deletion
+            memcache.set(GameEvent.HEAD_KEY % self.key.urlsafe(),
+                         self.events_logged + 1)
         except:
+            # Imported here so the task handlers in main.py, which use
+            # models but not the API, do not load endpoints
+            import endpoints
             raise endpoints.InternalServerErrorException('Could not delete')
 
+    def log_event(self, kind, user, move=None, result=None):
+        """Add a GameEvent for spectators, stored together with the game by
+        save
+
+        Args:
+            kind: 'move' or 'result'
+            user: user key the event is about (the winner for a result)
+            move, result: move made or result text
+
+        """
+        self.events_logged += 1
+        self._save_with_game(GameEvent(
+            parent=self.key, id=self.events_logged,
+            sequence=self.events_logged, kind=kind, user=user, move=move,
+            result=result))
+
+    def _save_with_game(self, *entities):
+        """Add entities to be stored together with the game by save"""
+        self.__dict__.setdefault('_unsaved', []).extend(entities)
+
+    def save(self):
+        """Store the game, its new GameEvents and the users whose statistics
+        changed in a single put, and publish the new event count once it is
+        committed. Call it in the transaction that read the game, so that a
+        concurrent save makes the transaction retry instead of reusing
+        event ids
+
+        """
+        ndb.put_multi([self] + self.__dict__.pop('_unsaved', []))
+        key = GameEvent.HEAD_KEY % self.key.urlsafe()
+        head = self.events_logged
+        ndb.get_context().call_on_commit(lambda: memcache.set(key, head))
+
+    def event_keys(self):
+        """Returns the keys of all GameEvents of this game"""
+        return GameEvent.query(ancestor=self.key).fetch(keys_only=True)
+
+    def archive(self):
+        """Build the compact archived form of an ended game. The caller is
+        responsible for storing the archive and deleting the game
+
+        Returns:
+            Object of class GameArchive keyed by the id of this game
+
+        """
+        if not self.game_ended:
+            raise ValueError("Only ended games can be archived")
+        moves = ''
+        for history in self.history:
+            row, col = history.move.split(',')
+            moves += str(int(row) * 3 + int(col))
+        return GameArchive(id=self.key.id(), userX=self.userX,
+                           userO=self.userO, winner=self.winner,
+                           draw=self.draw, turns_played=self.turns_played,
+                           moves=moves, ended=self.updated)
+
     def generateArray(self, symbol):
         """Mask a symbol with 1's and generate the board as matrix
 
@@ -327,6 +500,122 @@ class Game(ndb.Model):
         return 0
 
 
+class GameEvent(ndb.Model):
+    """Append-only log entry of a game, stored as a child of the Game with
+    the sequence number (starting at 1) as id. Spectators are also sent a
+    'cancelled' GameEventForm, not stored, when a game is cancelled"""
+    # memcache key holding the number of events logged for a game
+    HEAD_KEY = 'game_events:%s'
+
+    sequence = ndb.IntegerProperty(required=True, indexed=False)
+    kind = ndb.StringProperty(required=True, indexed=False)
+    user = ndb.KeyProperty(kind=User, indexed=False)
+    move = ndb.StringProperty(indexed=False)
+    result = ndb.StringProperty(indexed=False)
+
+    def to_form(self):
+        """Returns a GameEventForm representation of the event"""
+        form = GameEventForm()
+        form.sequence = self.sequence
+        form.kind = self.kind
+        if self.user:
+            form.user = User.get_name(self.user)
+        form.move = self.move
+        form.result = self.result
+        return form
+
+
+class GameArchive(ndb.Model):
+    """Compact record of an ended game. Moves are stored as a string of
+    cell indices (row * 3 + col) in the order they were played; X always
+    plays first so the board and history can be rebuilt from it"""
+    userX = ndb.KeyProperty(required=True, kind=User)
+    userO = ndb.KeyProperty(required=True, kind=User)
+    winner = ndb.KeyProperty(kind=User)
+    draw = ndb.BooleanProperty(default=False)
+    turns_played = ndb.IntegerProperty(default=0, indexed=False)
+    moves = ndb.StringProperty(indexed=False)
+    ended = ndb.DateTimeProperty()
+    archived = ndb.DateTimeProperty(auto_now_add=True)
+
+    def rows(self):
+        """Rebuild the final board from the moves
+
+        Returns:
+            List of the 3 rows of the board as strings
+
+        """
+        cells = ['_'] * 9
+        for i, cell in enumerate(self.moves or ''):
+            cells[int(cell)] = 'X' if i % 2 == 0 else 'O'
+        board = ''.join(cells)
+        return [board[0:3], board[3:6], board[6:9]]
+
+    def to_form(self, urlsafekey, message):
+        """Returns a GameForm representation of the archived game
+
+        Args:
+            urlsafekey of the original game and optional String message
+
+        Returns:
+            Game details in the GameForm format
+
+        """
+        form = GameForm()
+        form.userX = User.get_name(self.userX)
+        form.userO = User.get_name(self.userO)
+        form.row1, form.row2, form.row3 = self.rows()
+        form.turns_played = self.turns_played
+        # Same as Game.record_move: the player after the last move
+        if self.turns_played % 2 == 0:
+            form.next_turn = User.get_name(self.userX)
+        else:
+            form.next_turn = User.get_name(self.userO)
+        form.game_ended = True
+        form.urlsafekey = urlsafekey
+        form.message = message
+        form.draw = self.draw
+        return form
+
+    def to_historyform(self):
+        """Returns a GameHistoryForm representation of the archived moves"""
+        ret = GameHistoryForms()
+        for i, cell in enumerate(self.moves or ''):
+            form = GameHistoryForm()
+            form.sequence = i + 1
+            if i % 2 == 0:
+                form.user = User.get_name(self.userX)
+            else:
+                form.user = User.get_name(self.userO)
+            form.move = '%d,%d' % divmod(int(cell), 3)
+            ret.items.append(form)
+        if ret.items:
+            if self.draw:
+                ret.items[-1].result = 'Game drawn'
+            elif self.winner:
+                ret.items[-1].result = '%s won !' % User.get_name(self.winner)
+        return ret
+
+
+class StatsReconciliation(ndb.Model):
+    """A run of the job that rebuilds User statistics from game data"""
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty()
+    planned = ndb.BooleanProperty(default=False)
+    shards = ndb.IntegerProperty(default=0)
+    shards_done = ndb.IntegerProperty(default=0)
+    users_checked = ndb.IntegerProperty(default=0)
+    users_corrected = ndb.IntegerProperty(default=0)
+    users_skipped = ndb.IntegerProperty(default=0)
+    drift = ndb.IntegerProperty(default=0)
+
+
+class StatsShard(ndb.Model):
+    """Per-user counts from one shard of a StatsReconciliation run.
+    Stored as a child of the run"""
+    counts = ndb.JsonProperty()
+
+
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
     userX = messages.StringField(1, required=True)
@@ -343,6 +632,19 @@ class GameForm(messages.Message):
     turns_played = messages.IntegerField(12)
 
 
+class MoveDeltaForm(messages.Message):
+    """Compact outbound form with the result of a single move"""
+    row = messages.IntegerField(1, required=True)
+    col = messages.IntegerField(2, required=True)
+    symbol = messages.StringField(3, required=True)
+    turns_played = messages.IntegerField(4, required=True)
+    board = messages.IntegerField(5, required=True)
+    game_ended = messages.BooleanField(6, required=True)
+    draw = messages.BooleanField(7)
+    winner = messages.StringField(8)
+    next_turn = messages.StringField(9)
+
+
 class NewGameForm(messages.Message):
     """Form for creating a new game """
     userX = messages.StringField(1, required=True)
@@ -408,3 +710,19 @@ class GameHistoryForm(messages.Message):
 class GameHistoryForms(messages.Message):
     """Outbound form for all game history"""
     items = messages.MessageField(GameHistoryForm, 1, repeated=True)
+
+
+class GameEventForm(messages.Message):
+    """Outbound form for a single game event"""
+    sequence = messages.IntegerField(1, required=True)
+    kind = messages.StringField(2, required=True)
+    user = messages.StringField(3)
+    move = messages.StringField(4)
+    result = messages.StringField(5)
+
+
+class GameEventForms(messages.Message):
+    """Outbound form for the events of a game after an offset"""
+    items = messages.MessageField(GameEventForm, 1, repeated=True)
+    offset = messages.IntegerField(2)
+    game_ended = messages.BooleanField(3)
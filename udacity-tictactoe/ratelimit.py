@@ -0,0 +1,217 @@
+"""ratelimit.py - Token bucket admission control for the write endpoints.
+
+Every call is checked against a bucket for the caller and a global bucket
+shared by all callers. The caller is identified by something the request
+body cannot forge: the OAuth user if the call is authenticated, otherwise
+the client address. A caller has one bucket for all their games, so
+playing many games at once does not raise their limit. Bucket state lives
+in a pluggable store: the default InProcessStore keeps it per instance,
+MemcacheStore shares it across instances. Decisions are counted per
+instance and logged, so the limits can be tuned under load."""
+
+import collections
+import functools
+import httplib
+import logging
+import os
+import threading
+import time
+
+import endpoints
+from google.appengine.api import memcache
+from google.appengine.api import oauth
+
+
+class TooManyRequestsException(endpoints.ServiceException):
+    """Raised when a call is throttled by the rate limiter.
+
+    The Endpoints frontend turns statuses it does not know, such as 429,
+    into 404. 408 is one it remaps, to 503 backendError, which clients
+    treat as retryable and back off from.
+    """
+    http_status = httplib.REQUEST_TIMEOUT
+
+
+class InProcessStore(object):
+    """Keeps bucket state in a dict local to this instance. Only the
+    max_buckets most recently used buckets are kept; an evicted bucket
+    starts again full, like a caller that has been idle"""
+    def __init__(self, max_buckets=10000):
+        self._buckets = collections.OrderedDict()
+        self._max_buckets = max_buckets
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst, now):
+        """Take one token from a bucket, refilling it first
+        Args:
+            key: bucket name
+            rate: tokens added per second
+            burst: bucket capacity
+            now: current time in seconds
+        Returns:
+            True if a token was available"""
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self._max_buckets:
+                self._buckets.popitem(last=False)
+            return allowed
+
+
+class MemcacheStore(object):
+    """Keeps bucket state in memcache so all instances share the limits.
+    Uses compare-and-set, and lets the call through if the bucket is too
+    contended to update, so a memcache problem never blocks players.
+
+    A memcache.Client remembers the CAS ids of its gets, so each request
+    thread uses its own client.
+    """
+    RETRIES = 3
+
+    def __init__(self, namespace='ratelimit'):
+        self._local = threading.local()
+        self._namespace = namespace
+
+    def _client(self):
+        """Returns the memcache client of the current thread"""
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = memcache.Client()
+        return client
+
+    def consume(self, key, rate, burst, now):
+        """Same as InProcessStore.consume"""
+        client = self._client()
+        for _ in range(self.RETRIES):
+            state = client.gets(key, namespace=self._namespace)
+            if state is None:
+                if client.add(key, (burst - 1, now),
+                              namespace=self._namespace):
+                    return True
+                continue
+            tokens, last = state
+            tokens = min(burst, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if client.cas(key, (tokens, now), namespace=self._namespace):
+                return allowed
+        return True
+
+
+class RateLimiter(object):
+    """Per-caller and global token buckets in front of the write
+    endpoints.
+
+    Throttled calls are logged as they happen, and the counts of all
+    decisions made since the last report are logged at most every
+    LOG_INTERVAL seconds, so they can be summed over all instances.
+    """
+    # Seconds between logged reports of the decision counts
+    LOG_INTERVAL = 60
+
+    def __init__(self, store, user_rate, user_burst, global_rate,
+                 global_burst):
+        self.store = store
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self._stats = {}
+        self._unlogged = {}
+        self._logged_at = time.time()
+        self._lock = threading.Lock()
+
+    def allow(self, method, caller):
+        """Check a call against the caller and global buckets
+        Args:
+            method: name of the endpoint method being called
+            caller: bucket name of the caller, or None if unknown
+        Returns:
+            True if the call may proceed"""
+        now = time.time()
+        if caller is not None and not self.store.consume(
+                'caller:' + caller, self.user_rate, self.user_burst, now):
+            decision = 'throttled_user'
+        elif not self.store.consume('global', self.global_rate,
+                                    self.global_burst, now):
+            decision = 'throttled_global'
+        else:
+            decision = 'allowed'
+        if decision != 'allowed':
+            logging.warning('Rate limit: %s by %s %s', method, caller,
+                            decision)
+        report = None
+        with self._lock:
+            key = (method, decision)
+            self._stats[key] = self._stats.get(key, 0) + 1
+            self._unlogged[key] = self._unlogged.get(key, 0) + 1
+            if now - self._logged_at >= self.LOG_INTERVAL:
+                report, self._unlogged = self._unlogged, {}
+                self._logged_at = now
+        if report:
+            logging.info('Rate limit decisions: %s', ', '.join(
+                '%s %s=%d' % (method, decision, count) for
+                (method, decision), count in sorted(report.iteritems())))
+        return decision == 'allowed'
+
+    def stats(self):
+        """Returns decision counts as {method: {decision: count}}"""
+        result = {}
+        with self._lock:
+            for (method, decision), count in self._stats.iteritems():
+                result.setdefault(method, {})[decision] = count
+        return result
+
+
+def _make_limiter():
+    """Build the limiter from the RATE_LIMIT_* environment variables"""
+    if os.environ.get('RATE_LIMIT_BACKEND') == 'memcache':
+        store = MemcacheStore()
+    else:
+        store = InProcessStore()
+    return RateLimiter(
+        store,
+        user_rate=float(os.environ.get('RATE_LIMIT_USER_RATE', 2)),
+        user_burst=float(os.environ.get('RATE_LIMIT_USER_BURST', 10)),
+        global_rate=float(os.environ.get('RATE_LIMIT_GLOBAL_RATE', 200)),
+        global_burst=float(os.environ.get('RATE_LIMIT_GLOBAL_BURST', 400)))
+
+
+limiter = _make_limiter()
+
+
+def caller_id(service):
+    """Identify the caller of an endpoint method for rate limiting
+    Args:
+        service: the remote.Service handling the call
+    Returns:
+        The OAuth user email if the call is authenticated, otherwise the
+        client address"""
+    try:
+        user = endpoints.get_current_user()
+    except (endpoints.InvalidGetUserCall, oauth.Error):
+        # Not called through Endpoints, or with an invalid OAuth token
+        user = None
+    if user:
+        caller = user.email()
+    else:
+        state = getattr(service, 'request_state', None)
+        caller = getattr(state, 'remote_address', None) or 'unknown'
+    return caller
+
+
+def rate_limited(method):
+    """Decorator for endpoint methods that rejects throttled calls before
+    the method body runs, so no datastore access is made for them"""
+    @functools.wraps(method)
+    def wrapper(self, request):
+        if not limiter.allow(method.__name__, caller_id(self)):
+            raise TooManyRequestsException(
+                'Too many requests, try again later')
+        return method(self, request)
+    return wrapper
@@ -0,0 +1,233 @@
+"""simulate.py - Offline self-play simulator for stress testing the game rules
+and generating benchmark and training data.
+
+Games are played in batches held as NumPy arrays of boards, one row per game,
+with cells numbered row * 3 + col and 0 = empty, 1 = X, 2 = O (the same
+digits as Game.board_code). Simulating needs NumPy but no datastore.
+
+With --verify N, the first N games of the first batch are replayed through
+Game.record_move, check_winner and check_draw on an in-memory datastore stub
+to check the simulator and the model agree on every move and result. This
+needs the App Engine SDK on the python path.
+
+Usage:
+    python simulate.py --games 1000000 --x random --o scripted
+    python simulate.py --o table --table moves.json --verify 1000
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from symmetry import INVERSES, transform
+
+EMPTY, X, O, DRAW = 0, 1, 2, 3
+SYMBOLS = '_XO'
+LINES = np.array([[0, 1, 2], [3, 4, 5], [6, 7, 8],
+                  [0, 3, 6], [1, 4, 7], [2, 5, 8],
+                  [0, 4, 8], [2, 4, 6]])
+POWERS = 3 ** np.arange(9)
+# Cells tried in order by the scripted policy: centre, corners, then edges
+SCRIPTED_ORDER = [4, 0, 2, 6, 8, 1, 3, 5, 7]
+
+
+def encode(board):
+    """Pack a 9 character board string the same way as Game.board_code"""
+    return sum(SYMBOLS.index(cell) * 3 ** i for i, cell in enumerate(board))
+
+
+class RandomPolicy(object):
+    """Plays a uniformly random empty cell"""
+    def choose(self, boards, rng):
+        """Pick a move for each board
+        Args:
+            boards: array of shape (n, 9), each with at least one empty cell
+            rng: numpy RandomState
+        Returns:
+            Array of n cell indices"""
+        scores = rng.random_sample(boards.shape)
+        scores[boards != EMPTY] = -1
+        return scores.argmax(axis=1)
+
+
+class ScriptedPolicy(object):
+    """Plays the first empty cell from a fixed order"""
+    def __init__(self, order=SCRIPTED_ORDER):
+        self.priority = np.zeros(9)
+        self.priority[order] = np.arange(9, 0, -1)
+
+    def choose(self, boards, rng):
+        """Same as RandomPolicy.choose"""
+        return np.where(boards == EMPTY, self.priority, 0).argmax(axis=1)
+
+
+class TablePolicy(object):
+    """Plays moves from a JSON file mapping board strings to cells. Each
+    entry also covers the 7 rotations and reflections of its board, so the
+    file only needs canonical positions. Boards with no entry, or whose
+    entry is not an empty cell, are played by the fallback policy"""
+    def __init__(self, path, fallback=None):
+        with open(path) as f:
+            table = json.load(f)
+        self.moves = np.full(3 ** 9, -1, dtype=np.int8)
+        for board, cell in table.items():
+            for sym in range(8):
+                self.moves[encode(transform(board, sym))] = \
+                    INVERSES[sym][cell]
+        self.fallback = fallback or RandomPolicy()
+
+    def choose(self, boards, rng):
+        """Same as RandomPolicy.choose"""
+        cells = self.moves[boards.dot(POWERS)].astype(np.int64)
+        rows = np.arange(len(boards))
+        missing = ((cells < 0) |
+                   (boards[rows, np.maximum(cells, 0)] != EMPTY))
+        if missing.any():
+            cells[missing] = self.fallback.choose(boards[missing], rng)
+        return cells
+
+
+def play(n, policy_x, policy_o, rng):
+    """Play a batch of games to the end
+    Args:
+        n: number of games
+        policy_x, policy_o: policies for the X and O players
+        rng: numpy RandomState
+    Returns:
+        Tuple of final boards (n, 9), moves (n, 9) as cells in the order
+        played padded with -1, and results (n,) as X, O or DRAW"""
+    boards = np.zeros((n, 9), dtype=np.int8)
+    moves = np.full((n, 9), -1, dtype=np.int8)
+    results = np.zeros(n, dtype=np.int8)
+    active = np.arange(n)
+    for ply in range(9):
+        player = X if ply % 2 == 0 else O
+        policy = policy_x if player == X else policy_o
+        cells = policy.choose(boards[active], rng)
+        boards[active, cells] = player
+        moves[active, ply] = cells
+        # Same order as make_move: a win on the last cell is not a draw
+        won = (boards[active][:, LINES] == player).all(axis=2).any(axis=1)
+        results[active[won]] = player
+        active = active[~won]
+        if not len(active):
+            break
+    # Games still going after 9 moves have a full board
+    results[active] = DRAW
+    return boards, moves, results
+
+
+def verify(boards, moves, results):
+    """Replay games through the Game model and compare the outcomes
+    Args:
+        boards, moves, results: output of play for the games to check
+    Returns:
+        Number of games where the model disagrees with the simulator"""
+    from google.appengine.ext import testbed
+    from models import Game, User
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    try:
+        userX = User(name='simulatorX').put()
+        userO = User(name='simulatorO').put()
+        mismatches = 0
+        for i in range(len(results)):
+            game = Game.new_game(userX, userO)
+            valid = True
+            for ply, cell in enumerate(moves[i]):
+                if cell < 0:
+                    break
+                row, col = divmod(int(cell), 3)
+                if game.game_ended or not game.validate_move(row, col):
+                    valid = False
+                    break
+                game.record_move(row, col, 'X' if ply % 2 == 0 else 'O')
+                if not game.check_winner():
+                    game.check_draw()
+            if game.draw:
+                outcome = DRAW
+            elif game.winner == userX:
+                outcome = X
+            elif game.winner == userO:
+                outcome = O
+            else:
+                outcome = EMPTY
+            board = ''.join(SYMBOLS[cell] for cell in boards[i])
+            if (not valid or outcome != results[i] or
+                    board != game.board_string()):
+                mismatches += 1
+        return mismatches
+    finally:
+        bed.deactivate()
+
+
+def make_policy(name, table):
+    """Build a policy from its command line name"""
+    if name == 'random':
+        return RandomPolicy()
+    if name == 'scripted':
+        return ScriptedPolicy()
+    if not table:
+        raise SystemExit('--table is required for the table policy')
+    return TablePolicy(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=100000)
+    parser.add_argument('--x', default='random',
+                        choices=['random', 'scripted', 'table'])
+    parser.add_argument('--o', default='random',
+                        choices=['random', 'scripted', 'table'])
+    parser.add_argument('--table', help='JSON file of board -> cell')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--verify', type=int, default=0, metavar='N',
+                        help='replay N games through the Game model')
+    parser.add_argument('--output',
+                        help='save moves and results to this .npz file')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    policy_x = make_policy(args.x, args.table)
+    policy_o = make_policy(args.o, args.table)
+
+    totals = np.zeros(4, dtype=np.int64)
+    saved_moves, saved_results = [], []
+    elapsed = 0.0
+    played = 0
+    while played < args.games:
+        n = min(args.batch, args.games - played)
+        start = time.time()
+        boards, moves, results = play(n, policy_x, policy_o, rng)
+        elapsed += time.time() - start
+        totals += np.bincount(results, minlength=4)
+        if args.output:
+            saved_moves.append(moves)
+            saved_results.append(results)
+        if played == 0 and args.verify:
+            checked = min(args.verify, n)
+            mismatches = verify(boards[:checked], moves[:checked],
+                                results[:checked])
+            print('Verified %d games against the model: %d mismatches' %
+                  (checked, mismatches))
+        played += n
+
+    print('Played %d games in %.2f s (%.0f games/s)' %
+          (played, elapsed, played / max(elapsed, 1e-9)))
+    print('X won %d, O won %d, drawn %d' % (totals[X], totals[O],
+                                            totals[DRAW]))
+    if args.output:
+        np.savez_compressed(args.output,
+                            moves=np.concatenate(saved_moves),
+                            results=np.concatenate(saved_results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""stats.py - Functions for rebuilding User statistics from game data.
+
+Counts are kept as a dict of urlsafe user key -> [games_in_progress,
+games_completed, games_won, games_drawn] so that partial results from
+separate shards can be stored as JSON and merged."""
+
+IN_PROGRESS, COMPLETED, WON, DRAWN = range(4)
+FIELDS = ('games_in_progress', 'games_completed', 'games_won', 'games_drawn')
+
+
+def tally_games(games, counts=None):
+    """Count games per user
+    Args:
+        games: iterable of Game or GameArchive entities
+        counts: existing counts to add to, if any
+    Returns:
+        Dict of urlsafe user key -> list of counts"""
+    if counts is None:
+        counts = {}
+    for game in games:
+        # Archived games are always ended
+        ended = getattr(game, 'game_ended', True)
+        for player in (game.userX, game.userO):
+            row = counts.setdefault(player.urlsafe(), [0, 0, 0, 0])
+            if not ended:
+                row[IN_PROGRESS] += 1
+                continue
+            row[COMPLETED] += 1
+            if game.draw:
+                row[DRAWN] += 1
+            elif game.winner == player:
+                row[WON] += 1
+    return counts
+
+
+def merge_counts(partials):
+    """Sum several count dicts produced by tally_games"""
+    total = {}
+    for partial in partials:
+        for user, row in partial.iteritems():
+            current = total.setdefault(user, [0, 0, 0, 0])
+            for i in range(len(FIELDS)):
+                current[i] += row[i]
+    return total
+
+
+def count_drift(user, row):
+    """Measure how far the statistics of a user are from recomputed counts
+    Args:
+        user: User entity
+        row: recomputed counts for the user, or None if the user has no games
+    Returns:
+        Sum of the absolute differences between old and new counters"""
+    row = row or [0, 0, 0, 0]
+    return sum(abs((getattr(user, field) or 0) - row[i])
+               for i, field in enumerate(FIELDS))
+
+
+def correct_user(user, row):
+    """Overwrite the statistics of a user with recomputed counts
+    Args:
+        user: User entity
+        row: recomputed counts for the user, or None if the user has no games
+    Returns:
+        Sum of the absolute differences between old and new counters. The
+        user only needs to be stored when this is non zero"""
+    drift = count_drift(user, row)
+    for i, field in enumerate(FIELDS):
+        setattr(user, field, (row or [0, 0, 0, 0])[i])
+    return drift
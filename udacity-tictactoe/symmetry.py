@@ -0,0 +1,63 @@
+"""symmetry.py - Canonical forms of tic tac toe positions.
+
+A board is a 9 character string (row1 + row2 + row3) and a cell is an index
+row * 3 + col into it. The 8 rotations and reflections of the square map
+positions onto each other, so position-keyed caches and statistics store
+one canonical board for all of them. The permutation tables are computed
+once at import."""
+
+
+def _rotate(perm):
+    """Compose a permutation with a quarter turn clockwise"""
+    return tuple(perm[(2 - cell % 3) * 3 + cell // 3] for cell in range(9))
+
+
+def _reflect(perm):
+    """Compose a permutation with a left-right mirror"""
+    return tuple(perm[cell // 3 * 3 + 2 - cell % 3] for cell in range(9))
+
+
+def _build_permutations():
+    """Returns the 8 symmetries as tuples where perm[cell] is the cell of
+    the original board that moves to cell"""
+    perms = [tuple(range(9))]
+    for _ in range(3):
+        perms.append(_rotate(perms[-1]))
+    perms.extend([_reflect(perm) for perm in perms])
+    return tuple(perms)
+
+
+PERMUTATIONS = _build_permutations()
+# INVERSES[sym][cell] is the cell that cell of the original board moves to
+INVERSES = tuple(
+    tuple(perm.index(cell) for cell in range(9)) for perm in PERMUTATIONS)
+
+
+def transform(board, sym):
+    """Apply symmetry number sym (0-7, 0 is the identity) to a board"""
+    return ''.join([board[cell] for cell in PERMUTATIONS[sym]])
+
+
+def canonicalize(board):
+    """Find the canonical form of a board
+    Args:
+        board: 9 character board string
+    Returns:
+        Tuple of the canonical board, the smallest of its 8 symmetric
+        forms, and the symmetry that maps board onto it"""
+    best, best_sym = board, 0
+    for sym in range(1, 8):
+        candidate = transform(board, sym)
+        if candidate < best:
+            best, best_sym = candidate, sym
+    return best, best_sym
+
+
+def cell_to_canonical(cell, sym):
+    """Map a cell of the original board to the canonical board"""
+    return INVERSES[sym][cell]
+
+
+def cell_from_canonical(cell, sym):
+    """Map a cell of the canonical board back to the original board"""
+    return PERMUTATIONS[sym][cell]
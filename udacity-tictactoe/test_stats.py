@@ -0,0 +1,113 @@
+"""test_stats.py - Unit tests for stats.py. Needs no App Engine SDK.
+
+Run with: python -m unittest test_stats
+"""
+import unittest
+
+from stats import tally_games, merge_counts, count_drift, correct_user
+
+
+class FakeKey(object):
+    """Stands in for an ndb.Key of a User"""
+    def __init__(self, name):
+        self.name = name
+
+    def urlsafe(self):
+        return self.name
+
+
+class FakeGame(object):
+    """Stands in for a Game, or a GameArchive when game_ended is None"""
+    def __init__(self, userX, userO, game_ended=True, winner=None,
+                 draw=False):
+        self.userX = userX
+        self.userO = userO
+        self.winner = winner
+        self.draw = draw
+        if game_ended is not None:
+            self.game_ended = game_ended
+
+
+class FakeUser(object):
+    def __init__(self, games_in_progress=0, games_completed=0, games_won=0,
+                 games_drawn=0):
+        self.games_in_progress = games_in_progress
+        self.games_completed = games_completed
+        self.games_won = games_won
+        self.games_drawn = games_drawn
+
+
+A, B, C = FakeKey('a'), FakeKey('b'), FakeKey('c')
+
+
+class TallyGamesTest(unittest.TestCase):
+    def test_counts_each_outcome(self):
+        counts = tally_games([
+            FakeGame(A, B, winner=A),
+            FakeGame(B, C, draw=True),
+            FakeGame(A, C, game_ended=False),
+        ])
+        self.assertEqual(counts, {'a': [1, 1, 1, 0],
+                                  'b': [0, 2, 0, 1],
+                                  'c': [1, 1, 0, 1]})
+
+    def test_archives_count_as_ended(self):
+        counts = tally_games([FakeGame(A, B, game_ended=None, winner=B)])
+        self.assertEqual(counts, {'a': [0, 1, 0, 0], 'b': [0, 1, 1, 0]})
+
+    def test_adds_to_existing_counts(self):
+        counts = {'a': [1, 0, 0, 0]}
+        result = tally_games([FakeGame(A, B, winner=A)], counts)
+        self.assertIs(result, counts)
+        self.assertEqual(counts['a'], [1, 1, 1, 0])
+
+
+class MergeCountsTest(unittest.TestCase):
+    def test_sums_partials(self):
+        total = merge_counts([{'a': [1, 2, 1, 0]},
+                              {'a': [0, 1, 0, 1], 'b': [1, 0, 0, 0]},
+                              {}])
+        self.assertEqual(total, {'a': [1, 3, 1, 1], 'b': [1, 0, 0, 0]})
+
+    def test_does_not_modify_partials(self):
+        partial = {'a': [1, 1, 1, 1]}
+        merge_counts([partial, partial])
+        self.assertEqual(partial, {'a': [1, 1, 1, 1]})
+
+    def test_matches_single_tally(self):
+        games = [FakeGame(A, B, winner=A), FakeGame(B, C, draw=True),
+                 FakeGame(C, A, game_ended=False)]
+        self.assertEqual(
+            merge_counts([tally_games(games[:1]), tally_games(games[1:])]),
+            tally_games(games))
+
+
+class CorrectUserTest(unittest.TestCase):
+    def test_count_drift_does_not_modify_user(self):
+        user = FakeUser(games_won=3)
+        self.assertEqual(count_drift(user, [0, 1, 1, 0]), 3)
+        self.assertEqual(user.games_won, 3)
+
+    def test_overwrites_counters(self):
+        user = FakeUser(1, 2, 5, 0)
+        self.assertEqual(correct_user(user, [0, 3, 1, 1]), 7)
+        self.assertEqual((user.games_in_progress, user.games_completed,
+                          user.games_won, user.games_drawn), (0, 3, 1, 1))
+
+    def test_user_without_games_is_reset(self):
+        user = FakeUser(2, 1, 1, 0)
+        self.assertEqual(correct_user(user, None), 4)
+        self.assertEqual((user.games_in_progress, user.games_completed,
+                          user.games_won, user.games_drawn), (0, 0, 0, 0))
+
+    def test_unset_counters_count_as_zero(self):
+        user = FakeUser(None, None, None, None)
+        self.assertEqual(correct_user(user, [0, 1, 0, 0]), 1)
+
+    def test_no_drift(self):
+        user = FakeUser(0, 1, 1, 0)
+        self.assertEqual(correct_user(user, [0, 1, 1, 0]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
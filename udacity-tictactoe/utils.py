@@ -16,7 +16,28 @@ def get_by_urlsafe(urlsafe, model):
         The entity that the urlsafe Key string points to or None if no entity
         exists.
     Raises:
-        ValueError:"""
+        BadRequestException: if the key String is malformed or of the
+        incorrect kind"""
+    key = get_key_by_urlsafe(urlsafe, model)
+    entity = key.get()
+    if not entity:
+        return None
+    if not isinstance(entity, model):
+        raise ValueError('Incorrect Kind')
+    return entity
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key a urlsafe key string encodes, without reading the
+        entity. Checks that the key is of the correct kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The decoded ndb.Key
+    Raises:
+        BadRequestException: if the key String is malformed or of the
+        incorrect kind"""
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -26,10 +47,6 @@ def get_by_urlsafe(urlsafe, model):
             raise endpoints.BadRequestException('Invalid Key')
         else:
             raise
-
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity
\ No newline at end of file
+    if key.kind() != model._get_kind():
+        raise endpoints.BadRequestException('Incorrect Kind')
+    return key